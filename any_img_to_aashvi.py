@@ -1,22 +1,53 @@
-import requests
-from automation import AUTOMATIC1111_URL, check_if_automatic1111_is_active
-import traceback
+from automation import AUTOMATIC1111_URL, check_if_automatic1111_is_active, sd_session, AUTOMATIC1111_TIMEOUT
+from gspread.utils import rowcol_to_a1
 import json
-from utils import creds, get_gspread_client, send_messages
+from utils import creds, get_gspread_client, send_messages, ROOT_DIR, get_column_indices, format_traceback
 import base64
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import os
-from googleapiclient.http import MediaIoBaseDownload
-import io
+import shutil
+from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 service = build('drive', 'v3', credentials=creds)
+# drive folders the queued images are downloaded from
+RAW_FOLDER_ID = "1JZNYd_Q30ouTDx76YX4DmEiSb6KI9UFh"
+MASK_FOLDER_ID = "1aEJg4sPOyUS63OiaBIjHPeeLnXaJizu2"
+SKIN_MASK_FOLDER_ID = "1VCaEG3Rs6ZujBFwi1oMn7rbQlR9LlH5I"
+DOWNLOAD_WORKERS = 8
+thread_local = threading.local()
 file_name_to_id_map = {}
 file_name_to_mask_map = {}
 file_name_to_skin_mask_map = {}
 gsheet = get_gspread_client()
 
-ROOT_DIR = "/Users/rikenshah/Desktop/Fun/insta-model/"
+
+def get_thread_service():
+    # googleapiclient services aren't thread-safe, so every download thread builds its own
+    if not hasattr(thread_local, "service"):
+        thread_local.service = build('drive', 'v3', credentials=creds)
+    return thread_local.service
+
+
+def download_file(file, save_path):
+    path = save_path + file.get("name")
+    try:
+        request = get_thread_service().files().get_media(fileId=file.get("id"))
+        # stream straight into the file rather than buffering the whole image in memory first
+        with open(path, "wb") as f:
+            downloader = MediaIoBaseDownload(f, request)
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk()
+                print(F'Download {file.get("name")} {int(status.progress() * 100)}.')
+    except HttpError as error:
+        print(F'An error occurred: {error}')
+        # don't leave a half written image behind for the face fix to pick up
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def download_images(folder_id, save_path, to_map):
@@ -28,6 +59,8 @@ def download_images(folder_id, save_path, to_map):
             # pylint: disable=maybe-no-member
             response = service.files().list(q=f"'{folder_id}' in parents",
                                             spaces='drive',
+                                            # the default page is 100 files, ask for as many as drive allows
+                                            pageSize=1000,
                                             fields='nextPageToken, '
                                                    'files(id, name)',
                                             pageToken=page_token).execute()
@@ -35,34 +68,20 @@ def download_images(folder_id, save_path, to_map):
                 # Process change
                 to_map[file.get("name")] = file.get("id")
                 print(F'Found file: {file.get("name")}, {file.get("id")}')
-                file_id = file.get("id")
-                try:
-                    request = service.files().get_media(fileId=file_id)
-                    img = io.BytesIO()
-                    downloader = MediaIoBaseDownload(img, request)
-                    done = False
-                    while done is False:
-                        status, done = downloader.next_chunk()
-                        print(F'Download {int(status.progress() * 100)}.')
-                        with open(save_path + file.get("name"), "wb") as f:
-                            # print(img.getvalue(), file=f)
-                            f.write(img.getvalue())
-                except HttpError as error:
-                    print(F'An error occurred: {error}')
-
-            file = None
+
             files.extend(response.get('files', []))
             page_token = response.get('nextPageToken', None)
             if page_token is None:
                 break
+
+        # the files are independent, download them side by side
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            list(executor.map(download_file, files, repeat(save_path)))
     except HttpError as error:
         print(F'An error occurred: {error}')
         files = None
 
 
-from googleapiclient.http import MediaFileUpload
-
-
 def upload_image_to_drive(filename, folder_id, DIR):
     try:
         # create the file metadata
@@ -83,11 +102,12 @@ def upload_image_to_drive(filename, folder_id, DIR):
     return ""
 
 
-def move_file_to_folder(file_id, folder_id):
+def move_file_to_folder(file_id, folder_id, previous_parents=None):
     """Move specified file to the specified folder.
     Args:
         file_id: Id of the file to move.
         folder_id: Id of the folder
+        previous_parents: Id of the folder the file is in, looked up when not given
     Print: An object containing the new parent folder and other meta data
     Returns : Parent Ids for the file
 
@@ -99,9 +119,10 @@ def move_file_to_folder(file_id, folder_id):
     try:
 
         # pylint: disable=maybe-no-member
-        # Retrieve the existing parents to remove
-        file = service.files().get(fileId=file_id, fields='parents').execute()
-        previous_parents = ",".join(file.get('parents'))
+        # Retrieve the existing parents to remove, unless the caller already knows them
+        if previous_parents is None:
+            file = service.files().get(fileId=file_id, fields='parents').execute()
+            previous_parents = ",".join(file.get('parents'))
         # Move the file to the new folder
         file = service.files().update(fileId=file_id, addParents=folder_id,
                                       removeParents=previous_parents,
@@ -113,94 +134,157 @@ def move_file_to_folder(file_id, folder_id):
         return None
 
 
+IMG2IMG_HEADERS = {'Content-Type': 'application/json'}
+# controlnet model used for the pose of both the face fix and the skin pass
+OPENPOSE_MODEL = "control_v11p_sd15_openpose [cab727d4]"
+# img2img settings that are the same for every image, only the image, mask and a few knobs change per call
+FACE_FIX_BODY = {
+    "prompt": "a beautiful and cute aashvi-500, detailed skin, white skin, cloudy eyes, thick long haircut, light skin, "
+              "(high detailed skin:1.3), 8k UHD DSLR, bokeh effect, soft lighting, high quality",
+    # "enable_hr": True,
+    # "hr_resize_x": 1080,
+    # "hr_resize_y": 1080,
+    # "hr_upscaler": "R-ESRGAN 4x+",
+    # "hr_second_pass_steps": 20,
+    "seed": -1,
+    "sampler_index": "DPM++ 2M Karras",
+    "batch_size": 1,
+    "n_iter": 1,
+    "cfg_scale": 3,
+    "width": 512,
+    "height": 512,
+    "restore_faces": True,
+    "negative_prompt": "fingers, dress, (deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, "
+                       "drawing, anime:1.4), text, close up, cropped, out of frame, worst quality, low quality, "
+                       "jpeg artifacts, ugly, duplicate, morbid, mutilated, extra fingers, mutated hands, "
+                       "poorly drawn hands, poorly drawn face, mutation, deformed, blurry, dehydrated, "
+                       "bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, "
+                       "malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, "
+                       "too many fingers, long neck",
+    "send_images": True,
+    "save_images": False,
+    "include_init_images": True,
+}
+
+SKIN_MASK_BODY = {
+    "prompt": "detailed skin, light brown skin, cloudy eyes, black hair, thick long haircut, light skin,(high detailed skin:1.3), 8k UHD DSLR, bokeh effect, soft lighting, high quality",
+    # "enable_hr": True,
+    # "hr_resize_x": 1080,
+    # "hr_resize_y": 1080,
+    # "hr_upscaler": "R-ESRGAN 4x+",
+    "denoising_strength": 0.4,
+    "mask_blur": 18,
+    # "hr_second_pass_steps": 20,
+    "seed": -1,
+    "sampler_index": "DPM++ 2M Karras",
+    "batch_size": 1,
+    "n_iter": 1,
+    "steps": 150,
+    "cfg_scale": 12,
+    "width": 512,
+    "height": 512,
+    "restore_faces": False,
+    "negative_prompt": "dress, bra, clothing, (deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, "
+                       "drawing, anime:1.4), text, close up, cropped, out of frame, worst quality, low quality, "
+                       "jpeg artifacts, ugly, duplicate, morbid, mutilated, extra fingers, mutated hands, "
+                       "poorly drawn hands, poorly drawn face, mutation, deformed, blurry, dehydrated, "
+                       "bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, "
+                       "malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, "
+                       "too many fingers, long neck",
+    "send_images": True,
+    "save_images": False,
+    "include_init_images": True,
+}
+
+
+def openpose_controlnet(module, image_base64):
+    # pass the init image to the unit explicitly, controlnet versions differ on what they use without one.
+    # it is the same str object as init_images, nothing is copied before json.dumps
+    return {
+        "controlnet": {
+            "args": [
+                {"input_image": image_base64,
+                 "module": module,
+                 "model": OPENPOSE_MODEL, }
+            ]
+        }
+    }
+
+
+def img2img(body):
+    response = sd_session.post(AUTOMATIC1111_URL + "sdapi/v1/img2img", data=json.dumps(body), headers=IMG2IMG_HEADERS,
+                               timeout=AUTOMATIC1111_TIMEOUT)
+    if response.status_code != 200:
+        # error pages from the tunnel aren't json, report the raw text instead of failing to parse it
+        raise Exception(f"img2img failed with {response.status_code}: {response.text[:500]}")
+    return response.json()['images'][0]
+
+
 def face_fix_process():
     IMAGE_FILES = [i for i in os.listdir(ROOT_DIR + "raw/")]
     print("found images: ", IMAGE_FILES)
-    for image in IMAGE_FILES:
-        # avoid if file already exists
-        # if os.path.exists(f"./final/{image}"):
-        #     continue
-        original_img_path = f"{ROOT_DIR}raw/{image}"
-        mask_path = f"{ROOT_DIR}mask/{image}"
-        original_image_base64 = None
-        mask_base64 = None
-        name, ext = image.split(".")
-        is_img_from_xcel = name.isnumeric()
+    # column positions and the row of every index are read once, instead of a sheet.find() per image
+    cols = get_column_indices(gsheet)
+    index_rows = {}
+    for row, value in enumerate(gsheet.col_values(1), start=1):
+        index_rows.setdefault(value, row)
+    # sheet changes are collected and written in one request once the loop is done
+    updates = []
+    try:
+        for image in IMAGE_FILES:
+            # avoid if file already exists
+            # if os.path.exists(f"./final/{image}"):
+            #     continue
+            original_img_path = f"{ROOT_DIR}raw/{image}"
+            mask_path = f"{ROOT_DIR}mask/{image}"
+            original_image_base64 = None
+            mask_base64 = None
+            name, ext = image.split(".")
+            is_img_from_xcel = name.isnumeric()
 
-        try:
-            with open(original_img_path, "rb") as img_file:
-                original_image_base64 = base64.b64encode(img_file.read()).decode()
-            with open(mask_path, "rb") as img_file:
-                mask_base64 = base64.b64encode(img_file.read()).decode()
-        except Exception as e:
-            print(e)
-            continue
-        # Call Img2Img API with image and mask
-        headers = {'Content-Type': 'application/json'}
-
-        body = {
-            "prompt": "a beautiful and cute aashvi-500, detailed skin, white skin, cloudy eyes, thick long haircut, light skin, "
-                      "(high detailed skin:1.3), 8k UHD DSLR, bokeh effect, soft lighting, high quality",
-            # "enable_hr": True,
-            # "hr_resize_x": 1080,
-            # "hr_resize_y": 1080,
-            # "hr_upscaler": "R-ESRGAN 4x+",
-            "denoising_strength": 0.8 if is_img_from_xcel else 0.85,
-            "mask_blur": 18 if is_img_from_xcel else 15,
-            # "hr_second_pass_steps": 20,
-            "seed": -1,
-            "sampler_index": "DPM++ 2M Karras",
-            "batch_size": 1,
-            "n_iter": 1,
-            "steps": 140 if is_img_from_xcel else 180,
-            "cfg_scale": 3,
-            "width": 512,
-            "height": 512,
-            "restore_faces": True,
-            "negative_prompt": "fingers, dress, (deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, "
-                               "drawing, anime:1.4), text, close up, cropped, out of frame, worst quality, low quality, "
-                               "jpeg artifacts, ugly, duplicate, morbid, mutilated, extra fingers, mutated hands, "
-                               "poorly drawn hands, poorly drawn face, mutation, deformed, blurry, dehydrated, "
-                               "bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, "
-                               "malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, "
-                               "too many fingers, long neck",
-            "send_images": True,
-            "save_images": False,
-            "mask": mask_base64,
-            "init_images": [original_image_base64],
-            "include_init_images": True,
-            "alwayson_scripts": {
-                "controlnet": {
-                    "args": [
-                        {"input_image": original_image_base64,
-                         "module": "openpose_face",
-                         "model": "control_v11p_sd15_openpose [cab727d4]", }
-                    ]
-                }
+            try:
+                with open(original_img_path, "rb") as img_file:
+                    original_image_base64 = base64.b64encode(img_file.read()).decode()
+                with open(mask_path, "rb") as img_file:
+                    mask_base64 = base64.b64encode(img_file.read()).decode()
+            except Exception as e:
+                print(e)
+                continue
+            # Call Img2Img API with image and mask
+            body = {
+                **FACE_FIX_BODY,
+                "denoising_strength": 0.8 if is_img_from_xcel else 0.85,
+                "mask_blur": 18 if is_img_from_xcel else 15,
+                "steps": 140 if is_img_from_xcel else 180,
+                "mask": mask_base64,
+                "init_images": [original_image_base64],
+                "alwayson_scripts": openpose_controlnet("openpose_face", original_image_base64),
             }
-        }
-        x = json.dumps(body)
-        print(AUTOMATIC1111_URL)
-        resp = requests.post(AUTOMATIC1111_URL + "sdapi/v1/img2img", data=x, headers=headers, ).json()
-        img_data = resp['images'][0]
-        # save image
-        img_data = base64.b64decode(img_data)
-        with open(f"{ROOT_DIR}final/{image}", "wb") as fh:
-            fh.write(img_data)
-            if image in file_name_to_mask_map:
-                move_file_to_folder(file_name_to_mask_map[image], "1wVXqsunwblNZDBEMz63_alrdgPWbtA5k")
-        if is_img_from_xcel:
-            img_fixed = gsheet.find('img_fixed')
-            image_cell = gsheet.find("image")
-            hyperlink_imge = gsheet.find("hyperlink_image")
-            index = gsheet.find(name)
-            url = upload_image_to_drive(f"final/{image}", "1rEysVX6M0vEZFYGbdDVc96G4ZBXYhDDs", "final/")
-            print("updating tht excel sheet", url)
-            gsheet.update_cell(index.row, image_cell.col, f'=IMAGE("{url}", 4, 120, 120)')
-            gsheet.update_cell(index.row, hyperlink_imge.col, f'=HYPERLINK("{url}", "Link")')
-            gsheet.update_cell(index.row, img_fixed.col, "TRUE")
-            if image in file_name_to_id_map:
-                move_file_to_folder(file_name_to_id_map[image], "10PtowEawQ-81V4lSkM4K3-r-xQ-T7dW7")
+            print(AUTOMATIC1111_URL)
+            img_data = img2img(body)
+            # save image
+            img_data = base64.b64decode(img_data)
+            with open(f"{ROOT_DIR}final/{image}", "wb") as fh:
+                fh.write(img_data)
+                if image in file_name_to_mask_map:
+                    move_file_to_folder(file_name_to_mask_map[image], "1wVXqsunwblNZDBEMz63_alrdgPWbtA5k", MASK_FOLDER_ID)
+            if is_img_from_xcel:
+                if name not in index_rows:
+                    print(f"Couldn't find row {name} in the sheet")
+                    continue
+                row = index_rows[name]
+                url = upload_image_to_drive(f"final/{image}", "1rEysVX6M0vEZFYGbdDVc96G4ZBXYhDDs", "final/")
+                print("updating tht excel sheet", url)
+                updates += [
+                    {"range": rowcol_to_a1(row, cols["image"]), "values": [[f'=IMAGE("{url}", 4, 120, 120)']]},
+                    {"range": rowcol_to_a1(row, cols["hyperlink_image"]), "values": [[f'=HYPERLINK("{url}", "Link")']]},
+                    {"range": rowcol_to_a1(row, cols["img_fixed"]), "values": [["TRUE"]]},
+                ]
+                if image in file_name_to_id_map:
+                    move_file_to_folder(file_name_to_id_map[image], "10PtowEawQ-81V4lSkM4K3-r-xQ-T7dW7", RAW_FOLDER_ID)
+    finally:
+        if updates:
+            gsheet.batch_update(updates, value_input_option="USER_ENTERED")
 
 
 def skin_masks_process():
@@ -228,8 +312,6 @@ def skin_masks_process():
             continue
         print(len(original_image_base64), len(mask_base64))
         # Call Img2Img API with image and mask
-        headers = {'Content-Type': 'application/json'}
-        import cv2
 
         # body = {
         #     "prompt": "highly detailed, brown skin, match with face, "
@@ -273,49 +355,9 @@ def skin_masks_process():
         #     }
         # }
 
-        body = {
-            "prompt": "detailed skin, light brown skin, cloudy eyes, black hair, thick long haircut, light skin,(high detailed skin:1.3), 8k UHD DSLR, bokeh effect, soft lighting, high quality",
-            # "enable_hr": True,
-            # "hr_resize_x": 1080,
-            # "hr_resize_y": 1080,
-            # "hr_upscaler": "R-ESRGAN 4x+",
-            "denoising_strength": 0.4,
-            "mask_blur": 18,
-            # "hr_second_pass_steps": 20,
-            "seed": -1,
-            "sampler_index": "DPM++ 2M Karras",
-            "batch_size": 1,
-            "n_iter": 1,
-            "steps": 150,
-            "cfg_scale": 12,
-            "width": 512,
-            "height": 512,
-            "restore_faces": False,
-            "negative_prompt": "dress, bra, clothing, (deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, "
-                               "drawing, anime:1.4), text, close up, cropped, out of frame, worst quality, low quality, "
-                               "jpeg artifacts, ugly, duplicate, morbid, mutilated, extra fingers, mutated hands, "
-                               "poorly drawn hands, poorly drawn face, mutation, deformed, blurry, dehydrated, "
-                               "bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, "
-                               "malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, "
-                               "too many fingers, long neck",
-            "send_images": True,
-            "save_images": False,
-            "mask": mask_base64,
-            "init_images": [original_image_base64],
-            "include_init_images": True,
-            "alwayson_scripts": {
-                "controlnet": {
-                    "args": [
-                        {"input_image": original_image_base64,
-                         "module": "openpose_full",
-                         "model": "control_v11p_sd15_openpose [cab727d4]", }
-                    ]
-                }
-            }
-        }
-        x = json.dumps(body)
-        resp = requests.post(AUTOMATIC1111_URL + "sdapi/v1/img2img", data=x, headers=headers, ).json()
-        img_data = resp['images'][0]
+        body = {**SKIN_MASK_BODY, "mask": mask_base64, "init_images": [original_image_base64],
+                "alwayson_scripts": openpose_controlnet("openpose_full", original_image_base64)}
+        img_data = img2img(body)
         # save image
         img_data = base64.b64decode(img_data)
         with open(f"{ROOT_DIR}processed/{image_path}", "wb") as fh:
@@ -323,9 +365,11 @@ def skin_masks_process():
             upload_image_to_drive(f"{ROOT_DIR}processed/{image_path}", "1xiEh0AGKjtPhztcqwY27IUC_t0xMzph_",
                                   f"processed/")
             if image_path in file_name_to_id_map:
+                # face_fix_process may have moved it already, so let drive tell us where it is
                 move_file_to_folder(file_name_to_id_map[image_path], "10PtowEawQ-81V4lSkM4K3-r-xQ-T7dW7")
             if image_path in file_name_to_skin_mask_map:
-                move_file_to_folder(file_name_to_skin_mask_map[image_path], "1JZWascB8Pgv1klKWh3lFOY4-46o3xsX6")
+                move_file_to_folder(file_name_to_skin_mask_map[image_path], "1JZWascB8Pgv1klKWh3lFOY4-46o3xsX6",
+                                    SKIN_MASK_FOLDER_ID)
 
 
 if __name__ == "__main__":
@@ -336,22 +380,27 @@ if __name__ == "__main__":
 
     print(AUTOMATIC1111_URL)
     # delete all the files in the folder
-    os.system(f"rm -rf {ROOT_DIR}/raw/*")
-    os.system(f"rm -rf {ROOT_DIR}/mask/*")
-    os.system(f"rm -rf {ROOT_DIR}/skin_masks/*")
-    os.system(f"rm -rf {ROOT_DIR}/processed/*")
-    os.system(f"rm -rf {ROOT_DIR}/final/*")
-    download_images("1JZNYd_Q30ouTDx76YX4DmEiSb6KI9UFh", f"{ROOT_DIR}/raw/", file_name_to_id_map)
-    download_images("1aEJg4sPOyUS63OiaBIjHPeeLnXaJizu2", f"{ROOT_DIR}/mask/", file_name_to_mask_map)
-    download_images("1VCaEG3Rs6ZujBFwi1oMn7rbQlR9LlH5I", f"{ROOT_DIR}/skin_masks/", file_name_to_skin_mask_map)
+    try:
+        for folder in ("raw", "mask", "skin_masks", "processed", "final"):
+            # a folder that can't be cleared must stop the run, not leave last run's images to be processed again
+            if os.path.exists(ROOT_DIR + folder):
+                shutil.rmtree(ROOT_DIR + folder)
+            os.makedirs(ROOT_DIR + folder)
+    except Exception as e:
+        print("Error clearing the working folders", e)
+        send_messages(f"Error clearing the working folders {e} \n {format_traceback()}")
+        exit(1)
+    download_images(RAW_FOLDER_ID, f"{ROOT_DIR}/raw/", file_name_to_id_map)
+    download_images(MASK_FOLDER_ID, f"{ROOT_DIR}/mask/", file_name_to_mask_map)
+    download_images(SKIN_MASK_FOLDER_ID, f"{ROOT_DIR}/skin_masks/", file_name_to_skin_mask_map)
     try:
         face_fix_process()
     except Exception as e:
         print("Error in face fix process", e)
-        send_messages(f"Error in face fix process {e} \n {traceback.print_exc()}")
+        send_messages(f"Error in face fix process {e} \n {format_traceback()}")
 
     try:
         skin_masks_process()
     except Exception as e:
         print("Error in skin masks process", e)
-        send_messages(f"Error in skin masks process {e} \n {traceback.print_exc()}")
+        send_messages(f"Error in skin masks process {e} \n {format_traceback()}")
@@ -1,48 +1,79 @@
 import os
 import uuid
 from datetime import datetime
-import pyperclip
 import shutil
 import gspread
-import undetected_chromedriver as uc
+from gspread.utils import rowcol_to_a1
+from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
 from selenium.webdriver.common.action_chains import ActionChains
 from time import sleep
 import requests
 import json
-from googleapiclient.http import MediaFileUpload
+import re
+from googleapiclient.http import MediaIoBaseUpload
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import openai
 import base64
+import io
 import random
-from utils import setup_openai, creds, get_gspread_client, generate_uuid, send_messages
+from functools import lru_cache
+from utils import setup_openai, creds, get_gspread_client, generate_uuid, send_messages, ROOT_DIR, HEADER_ROW, \
+    get_column_indices
 
 setup_openai()
 AUTOMATIC1111_URL = ""
+# keep-alive connection pool reused by every call to the Automatic1111 tunnel
+sd_session = requests.Session()
+AUTOMATIC1111_PROBE_TIMEOUT = 5  # seconds
+# (connect, read): fail fast when the tunnel is gone, but give a generation up to 15 minutes
+AUTOMATIC1111_TIMEOUT = (10, 900)
+
+LOCATION_FILE = f"{ROOT_DIR}location.txt"
+AUTOMATIC1111_URL_FILE = f"{ROOT_DIR}automatic1111_url.txt"
+IS_RUNNING_FILE = f"{ROOT_DIR}is_running.txt"
+CHROME_PROFILE_DIR = f"{ROOT_DIR}profile-2"
+TUNNEL_URL_SUFFIXES = ("trycloudflare.com/", "ngrok-free.app", "ngrok-free.app/")
+# "Place Name: ..." / "Description: ..." lines of the post prompts response
+PLACE_PROMPT_RE = re.compile(r"(Place Name|Description)[^:\n]*:(.*)")
+# leading "1. " style numbering of list responses
+LIST_NUMBER_RE = re.compile(r"^\s*\d+\.\s*")
+OPENAI_MAX_ATTEMPTS = 5
+OPENAI_RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.ServiceUnavailableError,
+                           openai.error.Timeout, openai.error.APIConnectionError)
+POST_PROMPT_TEMPLATE = "a beautiful and cute aashvi-500, single girl, at {location}, {description}, long haircut, " \
+                       "light skin, (high detailed skin:1.3), 8k UHD DSLR, bokeh effect, soft lighting, high quality"
 
 client = gspread.authorize(creds)
 
 gsheet = get_gspread_client()
 
 driver = None
+# set when get_driver attached to an already running chrome instead of starting one
+driver_attached = False
+
+
+@lru_cache(maxsize=1)
+def get_drive_service():
+    # build the drive client once per process, its http connection is then reused for every upload
+    return build('drive', 'v3', credentials=creds)
 
 
 def upload_image_to_drive(filename, base64_image, folder_id):
     # decode the base64 image string
     image_data = base64.b64decode(base64_image)
-    # write the image data to a file
-    with open(f'/Users/rikenshah/Desktop/Fun/insta-model/{filename}', 'wb') as f:
-        f.write(image_data)
 
     try:
 
-        drive_service = build('drive', 'v3', credentials=creds)
+        drive_service = get_drive_service()
 
         # create the file metadata
         file_metadata = {'name': filename, 'parents': [folder_id]}
-        m = MediaFileUpload(f'/Users/rikenshah/Desktop/Fun/insta-model/{filename}', mimetype='image/png')
+        # upload straight from memory, no need for a local copy on disk
+        m = MediaIoBaseUpload(io.BytesIO(image_data), mimetype='image/png')
 
         # upload the image data
         media = drive_service.files().create(body=file_metadata, media_body=m, fields='id',
@@ -52,15 +83,32 @@ def upload_image_to_drive(filename, base64_image, folder_id):
         file_id = media.get('id')
 
         return f"https://drive.google.com/uc?export=view&id={file_id}"
-    except Exception as e:
-        print(f'An error occurred: {e}')
+    except HttpError as error:
+        print(F'An error occurred: {error}')
         raise
 
 
+def create_chat_completion(**kwargs):
+    # retry rate limits and transient api errors, waiting for Retry-After when openai sends it and
+    # adding jitter otherwise so parallel cron jobs don't retry in lockstep
+    for attempt in range(OPENAI_MAX_ATTEMPTS):
+        try:
+            return openai.ChatCompletion.create(**kwargs)
+        except OPENAI_RETRYABLE_ERRORS as e:
+            if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                raise
+            try:
+                delay = float((getattr(e, "headers", None) or {}).get("retry-after"))
+            except (TypeError, ValueError):
+                delay = random.uniform(1, min(30, 2 ** (attempt + 1)))
+            print(f"OpenAI request failed with {e}, retrying in {delay:.1f}s")
+            sleep(delay)
+
+
 def generate_caption(background):
     prompt = f"generate a instagram caption for this prompt 'a beautiful woman at a {background} background.' it should be creative, " \
              f"cute and funny. Feel Good. Use Emojis. In first person. Also add relevant hashtags."
-    completion = openai.ChatCompletion.create(
+    completion = create_chat_completion(
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": prompt},
@@ -72,7 +120,7 @@ def generate_caption(background):
 
 def generate_story_caption(background):
     prompt = f"generate a instagram story caption for the scene of {background} it should be creative, cute and funny. Feel Good. Use Emojis. In first person. Also add relevant hashtags. keep it only to few words"
-    completion = openai.ChatCompletion.create(
+    completion = create_chat_completion(
         model="gpt-3.5-turbo",
         messages=[
             {"role": "system", "content": prompt},
@@ -82,10 +130,15 @@ def generate_story_caption(background):
     return completion.choices[0].message["content"].replace('"', "").strip()
 
 
-def give_random_location_to_travel():
+@lru_cache(maxsize=1)
+def get_world_cities():
+    # the list is static, fetch it once per process
     res = requests.get("https://www.randomlists.com/data/world-cities-3.json")
-    countries = json.loads(res.text)["RandL"]["items"]
-    country = random.choice(countries)
+    return json.loads(res.text)["RandL"]["items"]
+
+
+def give_random_location_to_travel():
+    country = random.choice(get_world_cities())
     return country["name"] + ", " + country["detail"]
 
 
@@ -94,7 +147,7 @@ def generate_multiple_prompts(location):
     stylish clothes to wear, describe it in details. describe background in details. as a prompt you give to stable 
     diffusion,  describe the background, scene in as much details as you can, use the following format "Place Name: ... 
     Description: ..." """
-    completion = openai.ChatCompletion.create(
+    completion = create_chat_completion(
         model="gpt-3.5-turbo",
         temperature=0.9,
         messages=[
@@ -107,49 +160,22 @@ def generate_multiple_prompts(location):
 
     text = completion.choices[0].message["content"]
     final_prompts = []
-    starting_prompt = "a beautiful and cute aashvi-500, single girl,"
-    ending_prompt = "long haircut, light skin, (high detailed skin:1.3), 8k UHD DSLR, bokeh effect, soft lighting, " \
-                    "high quality"
-    index = 0
-    sub_prompt = []
     print(text)
     location = ""
-    for prompt in text.split("\n"):
-        try:
-            if prompt == "":
-                continue
-
-            is_place_name = False
-            if not ("Place Name" in prompt or "Description" in prompt):
-                continue
-            is_place_name = "Place Name" in prompt
-            # prompt = prompt[prompt.find(".") + 1:].strip()
-            _, prompt = prompt.split(":")
-            print(prompt)
-            if is_place_name:
-                index += 1
-                location = prompt
-                continue
-            print(is_place_name, index)
-            prompt = f"{starting_prompt} at {location}, {prompt}, {ending_prompt}"
-            final_prompts.append([location, prompt])
-            index += 1
-            if index >= 1:
-                pass
-            #     index = 0
-            #     print(is_place_name, index, sub_prompt)
-            # final_prompts.append(sub_prompt)
-            # sub_prompt = []
-        except Exception as e:
-            print(e)
+    for match in PLACE_PROMPT_RE.finditer(text):
+        label, value = match.group(1), match.group(2).strip()
+        print(value)
+        if label == "Place Name":
+            location = value
             continue
+        final_prompts.append([location, POST_PROMPT_TEMPLATE.format(location=location, description=value)])
 
     return final_prompts
 
 
 def generate_multiple_story_prompts(location):
     prompt = f"""Give me prompts describing the beauty of {location}. Doing different activity, Be very descriptive for background."""
-    completion = openai.ChatCompletion.create(
+    completion = create_chat_completion(
         model="gpt-3.5-turbo",
         temperature=0.71,
         max_tokens=400,
@@ -163,9 +189,9 @@ def generate_multiple_story_prompts(location):
 
     final_prompts = []
     for prompt in text.split("\n"):
+        prompt = LIST_NUMBER_RE.sub("", prompt).strip()
         if prompt == "":
             continue
-        prompt = prompt[prompt.find(".") + 1:].strip()
         final_prompts.append(prompt)
 
     return final_prompts
@@ -213,14 +239,18 @@ def generate_multiple_story_prompts(location):
 
 def check_if_automatic1111_is_active():
     global AUTOMATIC1111_URL
-    with open("/Users/rikenshah/Desktop/Fun/insta-model/automatic1111_url.txt", "r") as f:
+    with open(AUTOMATIC1111_URL_FILE, "r") as f:
         AUTOMATIC1111_URL = f.read().strip()
     if AUTOMATIC1111_URL != "":
         print("URL:", AUTOMATIC1111_URL + "sdapi/v1/memory")
-        response = requests.get(AUTOMATIC1111_URL + "sdapi/v1/memory")
-        if response.status_code == 200:
-            print("Automatic1111 is active")
-            return AUTOMATIC1111_URL
+        try:
+            # a liveness check, a dead tunnel shouldn't hang the run
+            response = sd_session.get(AUTOMATIC1111_URL + "sdapi/v1/memory", timeout=AUTOMATIC1111_PROBE_TIMEOUT)
+            if response.status_code == 200:
+                print("Automatic1111 is active")
+                return AUTOMATIC1111_URL
+        except requests.exceptions.RequestException as e:
+            print("Couldn't reach Automatic1111", e)
     print("Automatic1111 is not active")
     return False
 
@@ -228,13 +258,31 @@ def check_if_automatic1111_is_active():
 def close_automatic1111():
     global AUTOMATIC1111_URL, driver
     if driver is not None:
-        driver.quit()
+        quit_driver(driver)
         driver = None
     AUTOMATIC1111_URL = ""
 
 
 def get_driver():
-    global driver
+    global driver, driver_attached
+    debugger_address = os.getenv("CHROME_DEBUGGER_ADDRESS")
+    if debugger_address:
+        # attach to a chrome kept running with --remote-debugging-port, skips the browser start and keeps the logins warm.
+        # plain selenium here, uc.Chrome always launches its own browser (with a temp profile) even when attaching
+        attach_options = webdriver.ChromeOptions()
+        attach_options.debugger_address = debugger_address
+        try:
+            driver = webdriver.Chrome(options=attach_options)
+            # work in our own tab, so closing it later leaves whatever else is open in that chrome alone
+            driver.switch_to.new_window("tab")
+            driver_attached = True
+            return driver
+        except (WebDriverException, ConnectionError) as e:
+            print(f"Couldn't attach to chrome at {debugger_address}, starting a new one", e)
+            send_messages(f"Couldn't attach to chrome at {debugger_address}, started a new one instead\n {e}")
+
+    # imported here so scripts that never open a browser don't pay for loading it
+    import undetected_chromedriver as uc
     options = uc.ChromeOptions()
 
     # uc.TARGET_VERSION = 120
@@ -245,32 +293,42 @@ def get_driver():
     #     executable_path='/Users/rikenshah/Desktop/Fun/insta-model/chromedriver.sh',
     # )
 
+    driver_attached = False
     driver = uc.Chrome(
-        options=options, user_data_dir="/Users/rikenshah/Desktop/Fun/insta-model/profile-2",
+        options=options, user_data_dir=CHROME_PROFILE_DIR,
     )
     return driver
 
 
+def quit_driver(web_driver):
+    if driver_attached:
+        # the attached chrome is kept running between runs, only close our tab and stop chromedriver
+        web_driver.close()
+        web_driver.service.stop()
+    else:
+        web_driver.quit()
+
+
 def connect_to_automatic1111_api(user=0):
-    global driver, AUTOMATIC1111_URL, options
+    global driver, AUTOMATIC1111_URL
 
     def get_automatic1111_url():
-        global AUTOMATIC1111_URL, options
+        global AUTOMATIC1111_URL
         retry = 15
         while retry != 0:
             try:
                 found = False
-                a = None
+                href = None
                 for a in driver.find_elements(By.XPATH, "//colab-static-output-renderer/div[1]/div/pre/a"):
-                    print(a.get_attribute("href"))
-                    if a.get_attribute(
-                            "href").endswith("trycloudflare.com/") or a.get_attribute("href").endswith(
-                        "ngrok-free.app") or a.get_attribute("href").endswith("ngrok-free.app/"):
+                    # every get_attribute is a round-trip to the browser, fetch it once
+                    href = a.get_attribute("href")
+                    print(href)
+                    if href and href.endswith(TUNNEL_URL_SUFFIXES):
                         found = True
                         break
                 if not found:
                     raise NoSuchElementException("Couldn't find the link")
-                AUTOMATIC1111_URL = a.get_attribute("href")
+                AUTOMATIC1111_URL = href
                 print("Found the link " + AUTOMATIC1111_URL)
                 break
             except NoSuchElementException:
@@ -286,9 +344,8 @@ def connect_to_automatic1111_api(user=0):
         return
     AUTOMATIC1111_URL = ""
     if driver is not None:
-        driver.quit()
+        quit_driver(driver)
         # driver.close()
-        options = uc.ChromeOptions()
     driver = get_driver()
     driver.get(f"https://colab.research.google.com/drive/1Ezb1humDZNX35w0YJHWbk7E7z-qA9WrX?authuser={user}")
     sleep(30)
@@ -342,7 +399,7 @@ def connect_to_automatic1111_api(user=0):
 
     if not check_if_automatic1111_is_active():
         print("Couldn't find the link, please try again")
-        driver.quit()
+        quit_driver(driver)
         driver = None
         exit(1)
         return None
@@ -399,29 +456,30 @@ def get_payload(type, prompt, seed, negative_prompt):
 
 def generate_posts_and_caption(sheet):
     content = sheet.get_all_records(value_render_option="FORMULA")
-    image_cell = sheet.find('image')
-    caption_cell = sheet.find('caption')
-    generated_on = sheet.find('generated_on')
-    hyperlink = sheet.find('hyperlink_image')
+    cols = get_column_indices(sheet)
     negative_prompt = """(deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, sketch, cartoon, drawing, 
     anime:1.4), text, close up, cropped, out of frame, worst quality, low quality, jpeg artifacts, ugly, duplicate, 
     morbid, mutilated, extra fingers, mutated hands, poorly drawn hands, poorly drawn face, mutation, deformed, 
     blurry, dehydrated, bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, 
     malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, too many fingers, long neck """
+    # the /memory probe only needs to run before the first image, or again after something went wrong
+    sd_ready = False
     for row in content:
         try:
             if row['prompt'] != '':
                 if row['image'] == '':
-                    connect_to_automatic1111_api()
+                    if not sd_ready:
+                        connect_to_automatic1111_api()
+                        sd_ready = True
                     payload = get_payload(row['type'], row['prompt'], row['seed'] if row["seed"] != "" else -1,
                                           row['negative_prompt'] if 'negative_prompt' in row else negative_prompt)
                     headers = {'Content-Type': 'application/json'}
 
                     print(f"Running for {row['prompt']} and location {row['location']}")
-                    response = requests.post(f'{AUTOMATIC1111_URL}sdapi/v1/txt2img', headers=headers,
-                                             data=json.dumps(payload), timeout=900)
+                    response = sd_session.post(f'{AUTOMATIC1111_URL}sdapi/v1/txt2img', headers=headers,
+                                               data=json.dumps(payload), timeout=AUTOMATIC1111_TIMEOUT)
                     if response.status_code != 200:
-                        print("Failed to generate image with following error", response.json())
+                        print("Failed to generate image with following error", response.status_code, response.text)
                         close_automatic1111()
                         exit()
                     # decode the image data and upload it to the sheet
@@ -432,12 +490,15 @@ def generate_posts_and_caption(sheet):
                     # upload image to Google Drive
                     image_url = upload_image_to_drive(f"{index}-aashvi.png", img_data,
                                                       '1rEysVX6M0vEZFYGbdDVc96G4ZBXYhDDs')
-                    sheet.update_cell(image_cell.row + index, image_cell.col, f'=IMAGE("{image_url}", 4, 120, 120)')
-                    # sheet.update_cell(image_cell.row + index, image_cell.col, image_url)
-                    sheet.update_cell(generated_on.row + index, generated_on.col,
-                                      datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
-                    # image hyperlink
-                    sheet.update_cell(hyperlink.row + index, hyperlink.col, f'=HYPERLINK("{image_url}", "Link")')
+                    # image, generated_on and image hyperlink in a single request
+                    sheet.batch_update([
+                        {"range": rowcol_to_a1(HEADER_ROW + index, cols["image"]),
+                         "values": [[f'=IMAGE("{image_url}", 4, 120, 120)']]},
+                        {"range": rowcol_to_a1(HEADER_ROW + index, cols["generated_on"]),
+                         "values": [[datetime.now().strftime("%d/%m/%Y %H:%M:%S")]]},
+                        {"range": rowcol_to_a1(HEADER_ROW + index, cols["hyperlink_image"]),
+                         "values": [[f'=HYPERLINK("{image_url}", "Link")']]},
+                    ], value_input_option="USER_ENTERED")
 
                 if row['caption'] == '' and row['type'] == 'posts':
                     # generate the caption
@@ -446,21 +507,24 @@ def generate_posts_and_caption(sheet):
                             caption = generate_caption(row['location'])
                         else:
                             caption = generate_story_caption(row['prompt'])
-                        sheet.update_cell(caption_cell.row + int(row["index"]) + 1, caption_cell.col, caption)
+                        sheet.update_cell(HEADER_ROW + int(row["index"]) + 1, cols["caption"], caption)
                     except Exception as e:
                         print(e)
                         continue
         except Exception as e:
             print("something went wrong", e)
             send_messages(f"Something went wrong while generating image {e}")
+            sd_ready = False
             continue
     close_automatic1111()
 
 
 def get_last_index():
-    if len(gsheet.get_all_values()) == 0:
+    # only the index column is needed to count rows, avoid pulling the whole sheet (twice)
+    indexes = gsheet.col_values(1)
+    if len(indexes) == 0:
         return -1
-    return len(gsheet.get_all_records())
+    return len(indexes) - 1
 
 
 def generate_random_seed():
@@ -471,41 +535,48 @@ columns = ["index", "type", "prompt", "location", "group_id", "seed", "image", "
            "posted_on_instagram", "hyperlink_image"]
 
 
-def non_posted_instagram_posts():
-    values = gsheet.get_all_records(value_render_option="FORMULA")
-    group_ids = set()
+def get_non_posted_content_counts(values=None):
+    # all four counters in a single pass over the sheet
+    if values is None:
+        values = gsheet.get_all_records(value_render_option="FORMULA")
+    post_group_ids = set()
+    approved_post_group_ids = set()
+    stories = 0
+    approved_stories = 0
     for row in values:
-        if row["type"] == "posts" and row["posted_on_instagram"] == "":
-            print(row["group_id"], row["index"])
-            group_ids.add(row["group_id"])
-    return len(group_ids)
+        if row["posted_on_instagram"] != "":
+            continue
+        pending_approval = row["approved"] == "" and row["image"] != ""
+        if row["type"] == "posts":
+            post_group_ids.add(row["group_id"])
+            if pending_approval:
+                approved_post_group_ids.add(row["group_id"])
+        elif row["type"] == "story":
+            stories += 1
+            if pending_approval:
+                approved_stories += 1
+    return {
+        "non_posted_instagram_posts": len(post_group_ids),
+        "approved_non_posted_instagram_posts": len(approved_post_group_ids),
+        "non_posted_story": stories,
+        "approved_non_posted_story": approved_stories,
+    }
 
 
-def approved_non_posted_instagram_posts():
-    values = gsheet.get_all_records(value_render_option="FORMULA")
-    group_ids = set()
-    for row in values:
-        if row["type"] == "posts" and row["posted_on_instagram"] == "" and row["approved"] == "" and row["image"] != "":
-            group_ids.add(row["group_id"])
-    return len(group_ids)
+def non_posted_instagram_posts(values=None):
+    return get_non_posted_content_counts(values)["non_posted_instagram_posts"]
 
 
-def non_posted_story():
-    values = gsheet.get_all_records(value_render_option="FORMULA")
-    total = 0
-    for row in values:
-        if row["type"] == "story" and row["posted_on_instagram"] == "":
-            total += 1
-    return total
+def approved_non_posted_instagram_posts(values=None):
+    return get_non_posted_content_counts(values)["approved_non_posted_instagram_posts"]
 
 
-def approved_non_posted_story():
-    values = gsheet.get_all_records(value_render_option="FORMULA")
-    total = 0
-    for row in values:
-        if row["type"] == "story" and row["posted_on_instagram"] == "" and row["image"] != "" and row["approved"] == "":
-            total += 1
-    return total
+def non_posted_story(values=None):
+    return get_non_posted_content_counts(values)["non_posted_story"]
+
+
+def approved_non_posted_story(values=None):
+    return get_non_posted_content_counts(values)["approved_non_posted_story"]
 
 
 def v1_generate_prompts():
@@ -536,14 +607,34 @@ def v1_generate_prompts():
     gsheet.insert_rows(values, row=last_index + 2)
 
 
+# the location only changes once a day (new_location), every script run reads the same value
+@lru_cache(maxsize=1)
 def get_location():
-    with open("/Users/rikenshah/Desktop/Fun/insta-model/location.txt", "r") as f:
+    with open(LOCATION_FILE, "r") as f:
         return f.read().strip()
 
 
 def new_location(location):
-    with open("/Users/rikenshah/Desktop/Fun/insta-model/location.txt", "w") as f:
+    with open(LOCATION_FILE, "w") as f:
         f.write(location)
+    get_location.cache_clear()
+
+
+def is_process_running():
+    # the lock file only ever holds "yep" or "nope", no need to read more than a few bytes
+    try:
+        with open(IS_RUNNING_FILE, "rb") as f:
+            return f.read(8).strip() == b"yep"
+    except FileNotFoundError:
+        return False
+
+
+def set_process_running(is_running):
+    # write to a temp file and swap it in, so a crash mid-write never leaves a half written lock
+    tmp_path = IS_RUNNING_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("yep" if is_running else "nope")
+    os.replace(tmp_path, IS_RUNNING_FILE)
 
 
 def v1_generate_story_idea():
@@ -570,17 +661,12 @@ if __name__ == "__main__":
     # print(approved_non_posted_instagram_posts())
     # v1_generate_prompts()
     # v1_generate_story_idea()
-    is_running_path = "/Users/rikenshah/Desktop/Fun/insta-model/is_running.txt"
-    with open(is_running_path, "r") as f:
-        is_running = f.read().strip()
-        if is_running == "yep":
-            print("Already running")
-            exit()
+    if is_process_running():
+        print("Already running")
+        exit()
     send_messages("Running image and caption generation...")
 
-    with open(is_running_path, "w") as f:
-        f.write("yep")
+    set_process_running(True)
     generate_posts_and_caption(gsheet)
     send_messages("Stopping image and caption generation")
-    with open(is_running_path, "w") as f:
-        f.write("nope")
+    set_process_running(False)
@@ -1,39 +1,95 @@
 import shutil
-import traceback
+import tempfile
 import requests
-import undetected_chromedriver as uc
+from gspread.utils import rowcol_to_a1
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
 from automation import v1_generate_prompts, check_if_automatic1111_is_active, close_automatic1111, get_driver, \
-    get_location
+    get_location, quit_driver
 from time import sleep
-from utils import get_gspread_client, send_messages
+from utils import get_gspread_client, send_messages, ROOT_DIR, HEADER_ROW, get_column_indices, get_image_url, \
+    format_traceback, get_records
 from datetime import datetime
 import os
-import pyperclip
+from concurrent.futures import ThreadPoolExecutor
+from itertools import takewhile
 
 driver = None
 
-options = uc.ChromeOptions()
+# at most this many images of a group go into a single carousel post
+MAX_CAROUSEL_IMAGES = 6
+# how long to wait for an instagram ui element before giving up
+UI_TIMEOUT = 30
+# hashtags and mentions appended to every post caption, instagram allows at most MAX_HASHTAGS hashtags
+RAW_HASHTAGS = """ #digitalmodel #fashionista #fashiongram #styleblogger #fashionblogger #fashionmodel #modelling
+                #modelswanted #modelsearch #modelphotography #modelpose #modelstatus #modelsofinstagram #modelife 
+                #digitalinfluencer #VirtualModel #DigitalFashion""".replace("\n", "").strip()
+RAW_HASHTAGS_COUNT = RAW_HASHTAGS.count("#")
+MAX_HASHTAGS = 30
+MENTIONS = """@thevarunmayya @acknowledge.ai @eluna.ai"""
+# the only sheet columns posting reads
+POST_COLUMNS = ["index", "type", "approved", "posted_on_instagram", "image", "caption", "location", "group_id"]
+
+# elements of instagram's create post dialog, css/name where there is a stable attribute, xpath only to match on text
+CREATE_BUTTON = (By.XPATH, "//div[text()='Create']")
+FILE_INPUT = (By.CSS_SELECTOR,
+              "form > input[accept='image/jpeg,image/png,image/heic,image/heif,video/mp4,video/quicktime']")
+NEXT_BUTTON = (By.XPATH, "//div[text()='Next']")
+# only the filter step has the filters/adjustments tabs
+ADJUSTMENTS_TAB = (By.XPATH, "//*[text()='Adjustments']")
+CAPTION_INPUT = (By.CSS_SELECTOR, "div[aria-label='Write a caption...']")
+ACCESSIBILITY_TOGGLE = (By.XPATH, "//span[text()='Accessibility']")
+ALT_TEXT_INPUT = (By.CSS_SELECTOR, "[placeholder='Write alt text...']")
+LOCATION_INPUT = (By.NAME, "creation-location-input")
+SHARE_BUTTON = (By.XPATH, "//div[text()='Share']")
+
+# carousel images all come from the same drive host, keep the connection alive between them
+download_session = requests.Session()
+# drive throttles bursts with 429/5xx, back off (honouring Retry-After) instead of dropping the image
+download_session.mount("https://", HTTPAdapter(max_retries=Retry(total=5, backoff_factor=1,
+                                                                 status_forcelist=[429, 500, 502, 503, 504],
+                                                                 raise_on_status=False)))
+
 gsheet = get_gspread_client()
 
 
-def post_on_instagram(image_urls, caption, location):
-    global driver
-    i = 0
-    # download the image locally
-    downloaded_urls = []
-    for img_url in image_urls:
-        res = requests.get(img_url, stream=True)
-        if res.status_code == 200:
-            with open(f"/Users/rikenshah/Desktop/Fun/insta-model/temp{i}.png", 'wb') as f:
-                shutil.copyfileobj(res.raw, f)
-                downloaded_urls.append(f"/Users/rikenshah/Desktop/Fun/insta-model/temp{i}.png")
-                print('Image successfully Downloaded: ', img_url)
-                i += 1
-        else:
+def download_image(img_url, path):
+    # the with block hands the streamed connection back to the session's pool
+    with download_session.get(img_url, stream=True) as res:
+        if res.status_code != 200:
             print(f"Failed to download {img_url}")
+            return None
+        with open(path, 'wb') as f:
+            for chunk in res.iter_content(chunk_size=65536):
+                f.write(chunk)
+        print('Image successfully Downloaded: ', img_url)
+        return path
+
+
+def post_on_instagram(image_urls, caption, location):
+    # each post downloads into its own folder, so nothing clashes and cleanup is a single rmtree
+    temp_dir = tempfile.mkdtemp(prefix="post-", dir=ROOT_DIR)
+    try:
+        # download the images locally, all at once; map keeps the carousel order
+        paths = [os.path.join(temp_dir, f"temp{i}.png") for i in range(len(image_urls))]
+        with ThreadPoolExecutor(max_workers=MAX_CAROUSEL_IMAGES) as executor:
+            downloaded = executor.map(download_image, image_urls, paths)
+            # chrome is the slowest part to start, bring it up while the images download
+            open_instagram()
+        downloaded_urls = [path for path in downloaded if path is not None]
+
+        share_on_instagram(downloaded_urls, caption, location)
+        print(f"Successfully post {image_urls} on instagram")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
 
+def open_instagram():
+    global driver
     if driver is None:
         driver = get_driver()
         # driver = uc.Chrome(
@@ -42,101 +98,104 @@ def post_on_instagram(image_urls, caption, location):
         driver.get("https://www.instagram.com/aashvithemodel")
     else:
         driver.tab_new("https://www.instagram.com/aashvithemodel")
-    sleep(10)
-    driver.find_element(By.XPATH, "//div[text()='Create']").click()
-    sleep(2)
-    driver.find_element(By.XPATH,
-                        "//form/input[@accept='image/jpeg,image/png,image/heic,image/heif,video/mp4,video/quicktime']").send_keys(
-        "\n".join(downloaded_urls))
-    sleep(5)
-    driver.find_element(By.XPATH, "//div[text()='Next']").click()
-    sleep(1.2)
-    driver.find_element(By.XPATH, "//div[text()='Next']").click()
-    sleep(.9)
-    driver.find_element(By.XPATH, "//div[@aria-label='Write a caption...']").click()
-    sleep(1)
-    caption_element = driver.find_element(By.XPATH,
-                                          "//div[@aria-label='Write a caption...']")
-    pyperclip.copy(caption)
-    caption_element.send_keys(Keys.COMMAND, "v")
-    sleep(4)
+
+
+def wait_for(locator, condition=EC.element_to_be_clickable):
+    # return as soon as instagram has rendered the element instead of sleeping a fixed worst case
+    return WebDriverWait(driver, UI_TIMEOUT).until(condition(locator))
+
+
+def share_on_instagram(downloaded_urls, caption, location):
+    wait_for(CREATE_BUTTON).click()
+    # the file input is hidden, it only has to exist
+    wait_for(FILE_INPUT, EC.presence_of_element_located).send_keys("\n".join(downloaded_urls))
+    wait_for(NEXT_BUTTON).click()
+    # crop and filter steps both show "Next" in the same spot (possibly the same node), wait for the filter step itself
+    wait_for(ADJUSTMENTS_TAB, EC.presence_of_element_located)
+    wait_for(NEXT_BUTTON).click()
+    caption_element = wait_for(CAPTION_INPUT)
+    caption_element.click()
+    # type the caption straight into the editor, no clipboard round-trip (pbcopy) or paste delay needed
+    driver.execute_script("arguments[0].focus(); document.execCommand('insertText', false, arguments[1]);",
+                          caption_element, caption)
+    # the editor updates its state asynchronously, move on only once the whole caption is in it.
+    # compare with whitespace collapsed, .text trims every line so spaces before the line breaks never match
+    expected_caption = " ".join(caption.split())
+    WebDriverWait(driver, UI_TIMEOUT).until(lambda d: expected_caption in " ".join(caption_element.text.split()))
     # driver.find_element(By.XPATH, "//div[@aria-label='Write a caption...']")
     # sleep(1)
     caption_element.send_keys(Keys.ENTER)
-    sleep(2)
-    driver.find_element(By.XPATH, "//span[text()='Accessibility']").click()
-    sleep(1.2)
-    driver.find_element(By.XPATH, "//*[@placeholder='Write alt text...']").send_keys(
-        f"Aashvi at {location}")
-    sleep(1)
-    driver.find_element(By.XPATH, "//*[@name='creation-location-input']").send_keys(location)
-    sleep(4)
-    driver.find_element(By.XPATH, f"//span[contains(text(),'{location}')]").click()
-    sleep(2)
-    driver.find_element(By.XPATH, "//div[text()='Share']").click()
-    print(f"Successfully post {image_urls} on instagram")
+    wait_for(ACCESSIBILITY_TOGGLE).click()
+    wait_for(ALT_TEXT_INPUT).send_keys(f"Aashvi at {location}")
+    wait_for(LOCATION_INPUT).send_keys(location)
+    # pick the suggestion as soon as the autocomplete list shows it
+    wait_for((By.XPATH, f"//span[contains(text(),'{location}')]")).click()
+    wait_for(SHARE_BUTTON).click()
+    # nothing on the page tells us reliably when the upload is done, give it time before the browser closes
     sleep(20)
 
 
-def scheduled_posts_on_instagram():
-    content = gsheet.get_all_records(value_render_option="FORMULA")
-    posted_on_instagram = gsheet.find('posted_on_instagram')
-    group_id = ""
-    image_urls = []
-    caption = ""
-    location = ""
-    start_index = None
-    end_index = None
-    indexes = []
-    for row in content:
-        if row['index'] == '':
-            break
-        if row['approved'] == 'y' and row['posted_on_instagram'] == '' and row['type'] == "posts" and (
-                row["group_id"] == group_id or group_id == ""):
-            if row["image"] == "" or row["caption"] == "" or row["location"] == "" or row["group_id"] == "":
-                print(f"Missing values for {row['index']} row")
-                continue
-
-            if group_id == "":
-                start_index = row["index"]
-                group_id = row["group_id"]
-
-            image_url = row["image"].replace('=IMAGE("', "").replace('", 4, 120, 120)', "")
-            indexes.append(row["index"])
-            image_urls.append(image_url)
-
-            if row['caption'] != '-':
-                raw_caption = """ #digitalmodel #fashionista #fashiongram #styleblogger #fashionblogger #fashionmodel #modelling
-                #modelswanted #modelsearch #modelphotography #modelpose #modelstatus #modelsofinstagram #modelife 
-                #digitalinfluencer #VirtualModel #DigitalFashion""".replace("\n", "").strip()
+def build_caption(generated_caption):
+    raw_caption = RAW_HASHTAGS
+    extracted_caption = generated_caption[generated_caption.find("#"):].strip()
+    extracted_caption_count = extracted_caption.count("#")
 
-                max_hashtags = 30
+    caption_to_remove_from_raw = extracted_caption_count + RAW_HASHTAGS_COUNT - MAX_HASHTAGS
 
-                mentions = """@thevarunmayya @acknowledge.ai @eluna.ai"""
-                extracted_caption = row["caption"][row["caption"].find("#"):].strip()
-                raw_caption_count = raw_caption.count("#")
-                extracted_caption_count = extracted_caption.count("#")
+    if caption_to_remove_from_raw > 0:
+        raw_caption = "#" + " #".join(raw_caption.split(" #")[1:caption_to_remove_from_raw])
 
-                caption_to_remove_from_raw = extracted_caption_count + raw_caption_count - max_hashtags
+    if raw_caption == "#":
+        raw_caption = ""
 
-                if caption_to_remove_from_raw > 0:
-                    raw_caption = "#" + " #".join(raw_caption.split(" #")[1:caption_to_remove_from_raw])
+    return generated_caption[
+           :generated_caption.find("#"):] + "\n\n\n" + extracted_caption + raw_caption + "\n\n\n" + MENTIONS
 
-                if raw_caption == "#":
-                    raw_caption = ""
 
-                caption = row["caption"][
-                          :row["caption"].find("#"):] + "\n\n\n" + extracted_caption + raw_caption + "\n\n\n" + mentions
+def is_postable(row):
+    if row['approved'] != 'y' or row['posted_on_instagram'] != '' or row['type'] != "posts":
+        return False
+    if row["image"] == "" or row["caption"] == "" or row["location"] == "" or row["group_id"] == "":
+        print(f"Missing values for {row['index']} row")
+        return False
+    return True
 
-            main_location = get_location()
-            location = row["location"].replace(f",{main_location}", "").strip()
-            # print(f"Posting with URL: {image_url}, Caption: {caption}, Location: {location}")
 
+def scheduled_posts_on_instagram():
+    # the header row is enough to locate the column, find() would pull every cell of the sheet
+    columns = get_column_indices(gsheet)
+    posted_on_col = columns['posted_on_instagram']
+    content = get_records(gsheet, POST_COLUMNS, columns)
+    image_urls = []
+    caption = ""
+    location = ""
+    indexes = []
+    group_id = ""
+    main_location = get_location()
+    # the first postable row picks the group, its other rows are collected wherever they are in the sheet
+    for row in takewhile(lambda row: row['index'] != '', content):
+        if group_id not in ("", row["group_id"]) or not is_postable(row):
+            continue
+        group_id = row["group_id"]
+        image_url = get_image_url(row["image"])
+        indexes.append(row["index"])
+        image_urls.append(image_url)
+
+        if row['caption'] != '-':
+            caption = build_caption(row["caption"])
+
+        location = row["location"].replace(f",{main_location}", "").strip()
+        # print(f"Posting with URL: {image_url}, Caption: {caption}, Location: {location}")
+
+    # the caption and location can come from any row of the group, so only trim once every row was read
+    image_urls = image_urls[:MAX_CAROUSEL_IMAGES]
+    indexes = indexes[:MAX_CAROUSEL_IMAGES]
     if len(image_urls) > 0:
-        post_on_instagram(image_urls[:6], caption, location)
-        for i in indexes[:6]:
-            gsheet.update_cell(posted_on_instagram.row + i, posted_on_instagram.col,
-                               datetime.now().strftime("%Y-%m-%d %H:%M"))
+        post_on_instagram(image_urls, caption, location)
+        posted_on = datetime.now().strftime("%Y-%m-%d %H:%M")
+        # mark every posted row in a single request
+        gsheet.batch_update([{"range": rowcol_to_a1(HEADER_ROW + i, posted_on_col),
+                              "values": [[posted_on]]} for i in indexes], value_input_option="USER_ENTERED")
         send_messages("Successfully posted on instagram, checkout https://www.instagram.com/aashvithemodel")
     else:
         send_messages("No posts to post on instagram, please check the sheet")
@@ -148,10 +207,10 @@ if __name__ == '__main__':
         driver = None
     except Exception as e:
         print("Error while posting on instagram", e)
-        send_messages(f"Error while posting on instagram\n {e} \n {traceback.print_exc()}", )
+        send_messages(f"Error while posting on instagram\n {e} \n {format_traceback()}", )
     finally:
         if driver is not None:
-            driver.quit()
+            quit_driver(driver)
 
     if not check_if_automatic1111_is_active():
         send_messages("Automatic1111 is not active, please update the url \n Process has been stopped")
@@ -161,6 +220,6 @@ if __name__ == '__main__':
         v1_generate_prompts()
     except Exception as e:
         print("Error while generating prompts", e)
-        send_messages(f"Error while generating prompts\n {e} \n {traceback.print_exc()}", )
+        send_messages(f"Error while generating prompts\n {e} \n {format_traceback()}", )
     finally:
         close_automatic1111()
@@ -1,11 +1,13 @@
-from automation import uc, get_driver
+from automation import get_driver, quit_driver
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException
-from time import sleep
+from time import sleep, monotonic
 from utils import send_messages
 import os
 
+MAX_WAIT_SECONDS = 600  # 10 minutes
+
 
 def run_post_processing_collab():
     driver = get_driver()
@@ -13,22 +15,24 @@ def run_post_processing_collab():
     sleep(30)
     driver.find_element(By.TAG_NAME, "body").send_keys(Keys.COMMAND + Keys.F9)
     sleep(30)
-    max_attempt = 20 # 30 * 20 = 600 seconds = 10 minutes
-    while max_attempt > 0:
+    # poll quickly at first and back off up to 30 seconds, so a short run isn't held up by a full interval
+    deadline = monotonic() + MAX_WAIT_SECONDS
+    delay = 2
+    while monotonic() < deadline:
         try:
             driver.find_element(By.CSS_SELECTOR, ".cell.running")
-            sleep(30)
-            print(f"trying again in 30 seconds for {max_attempt} times")
-            max_attempt -= 1
         except NoSuchElementException:
             break
+        print(f"trying again in {delay} seconds")
+        sleep(delay)
+        delay = min(30, delay * 2)
     try:
         driver.find_element(By.CSS_SELECTOR, ".cell.running")
         print("Post processing collab still running after 10 minutes. Please check.")
         send_messages("Post processing collab still running after 10 minutes. Please check.")
     except NoSuchElementException:
         pass
-    driver.quit()
+    quit_driver(driver)
 
 
 if __name__ == '__main__':
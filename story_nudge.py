@@ -1,5 +1,6 @@
-import traceback
-from utils import get_gspread_client, send_images_to_bot, send_messages
+from gspread.utils import rowcol_to_a1
+from utils import get_gspread_client, send_images_to_bot, send_messages, get_column_indices, get_image_url, \
+    format_traceback, get_records
 from automation import v1_generate_story_idea, get_location
 from datetime import datetime
 
@@ -7,19 +8,26 @@ from datetime import datetime
 if __name__ == '__main__':
     gsheet = get_gspread_client()
     image_urls = []
+    updates = []
     i = 0
-    posted_on_instagram = gsheet.find("posted_on_instagram")
-    for row in gsheet.get_all_records(value_render_option="FORMULA"):
+    # the header row is enough to locate the column, find() would pull every cell of the sheet
+    columns = get_column_indices(gsheet)
+    posted_on_col = columns["posted_on_instagram"]
+    posted_on = datetime.now().strftime("%Y-%m-%d %H:%M")
+    for row in get_records(gsheet, ["index", "type", "posted_on_instagram", "image"], columns):
         if row["type"] == "story" and row["posted_on_instagram"] == "" and row["image"] != "":
             image_url = row["image"]
             print(image_url)
-            image_urls.append(image_url.replace("=IMAGE(\"", "").replace("\", 4, 120, 120)", ""))
+            image_urls.append(get_image_url(image_url))
             i += 1
-            gsheet.update_cell(row["index"]+1, posted_on_instagram.col,
-                               datetime.now().strftime("%Y-%m-%d %H:%M"))
+            updates.append({"range": rowcol_to_a1(row["index"]+1, posted_on_col),
+                            "values": [[posted_on]]})
             print(f"Story on instagram for {row['index']} row")
             if i == 4:
                 break
+    if updates:
+        # mark all picked stories as posted in a single request
+        gsheet.batch_update(updates, value_input_option="USER_ENTERED")
     if i == 0:
         send_messages("No stories to post, please check the sheet")
     else:
@@ -28,4 +36,4 @@ if __name__ == '__main__':
         v1_generate_story_idea()
     except Exception as e:
         print(e)
-        send_messages(f"Error generating story idea: {e} \n {traceback.print_exc()}")
+        send_messages(f"Error generating story idea: {e} \n {format_traceback()}")
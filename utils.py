@@ -1,7 +1,13 @@
+import re
+import string
+import traceback
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import openai
 import gspread
+from gspread.utils import rowcol_to_a1, numericise_all
 from google.oauth2.service_account import Credentials
 from dotenv import load_dotenv
 
@@ -9,54 +15,74 @@ load_dotenv()
 
 from os import getenv
 
+ROOT_DIR = "/Users/rikenshah/Desktop/Fun/insta-model/"
+HEADER_ROW = 1
+TELEGRAM_CHAT_ID = "1417419064"
+# telegram rejects sendMessage texts longer than this, counted in utf-16 code units (an emoji counts twice)
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+# keep the end of a traceback (where the error is), leaving room in the message for the error text
+TRACEBACK_TAIL_LENGTH = 3500
+# images are stored in the sheet as =IMAGE("<url>", 4, 120, 120)
+IMAGE_FORMULA_RE = re.compile(r'=IMAGE\("([^"]+)"')
 
 scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/spreadsheets",
          "https://www.googleapis.com/auth/drive"]
-creds = Credentials.from_service_account_file('/Users/rikenshah/Desktop/Fun/insta-model/aashvi-model-899f62fffa21.json',
+creds = Credentials.from_service_account_file(f'{ROOT_DIR}aashvi-model-899f62fffa21.json',
                                               scopes=scope)
 
+# every script sends a few bot messages per run, keep one connection to the webhook alive for all of them
+telegram_session = requests.Session()
+# sendMessage is a POST and not idempotent, a 5xx or read timeout may come after the message was already delivered.
+# only retry when the connection was never made or the bot api tells us to slow down (429)
+telegram_session.mount("https://", HTTPAdapter(max_retries=Retry(total=3, connect=3, read=0, backoff_factor=0.5,
+                                                                 status_forcelist=[429],
+                                                                 allowed_methods=["POST"],
+                                                                 raise_on_status=False)))
+
 
 def setup_openai():
     openai.organization =  getenv("OPENAI_ORGANIZATION")
     openai.api_key = getenv("OPENAI_API_KEY")
 
 
+def post_to_telegram(method, body):
+    body["chat_id"] = TELEGRAM_CHAT_ID
+    res = telegram_session.post(f"{getenv('TELEGRAM_WEBHOOK_URL')}/{method}", json=body)
+    if res.status_code != 200:
+        print("Error sending message", res.status_code, res.text)
+    return res
+
+
+def truncate_message(message):
+    encoded = message.encode("utf-16-le")
+    if len(encoded) <= TELEGRAM_MAX_MESSAGE_LENGTH * 2:
+        return message
+    # a cut through a surrogate pair leaves half an emoji, drop it
+    return encoded[:TELEGRAM_MAX_MESSAGE_LENGTH * 2].decode("utf-16-le", errors="ignore")
+
+
 def send_messages(message):
     body = {
         "message_id": str(uuid.uuid4()),
-        "text": message,
-        "chat_id": "1417419064"
+        "text": truncate_message(message),
     }
 
-    res = requests.post(f"{getenv('TELEGRAM_WEBHOOK_URL')}/sendMessage",
-                        json=body)
-
-    if res.status_code == 200:
+    if post_to_telegram("sendMessage", body).status_code == 200:
         print("Message sent")
-    else:
-        print("Error sending message", res.status_code, res.json())
 
 
 def send_images_to_bot(message, images):
-    body = {
-        "chat_id": "1417419064"
-    }
     send_messages(message)
-    medias = []
-    for img in images:
-        medias.append({
-            "type": "photo",
-            "media": img,
-
-        })
-    body["media"] = medias
+    body = {"media": [{"type": "photo", "media": img} for img in images]}
     print(body)
-    res = requests.post(f"{getenv('TELEGRAM_WEBHOOK_URL')}/sendMediaGroup", json=body)
+    res = post_to_telegram("sendMediaGroup", body)
     if res.status_code == 200:
         print(res.json())
         print("images sent")
-    else:
-        print("Error sending message", res.status_code, res.json())
+
+
+def format_traceback():
+    return traceback.format_exc()[-TRACEBACK_TAIL_LENGTH:]
 
 
 def get_gspread_client():
@@ -64,6 +90,39 @@ def get_gspread_client():
     return sheet
 
 
+def get_column_indices(sheet):
+    # one read of the header row instead of a sheet.find() round-trip per column name
+    columns = {}
+    for col, name in enumerate(sheet.row_values(HEADER_ROW), start=1):
+        columns.setdefault(name, col)
+    return columns
+
+
+def get_records(sheet, names, columns=None):
+    # like get_all_records, but only pulls the given columns instead of the whole sheet (prompts are most of it)
+    columns = columns or get_column_indices(sheet)
+    missing = [name for name in names if name not in columns]
+    if missing:
+        raise Exception(f"Sheet {sheet.title} has no {', '.join(missing)} column, was a header renamed?")
+    ranges = []
+    for name in names:
+        first_cell = rowcol_to_a1(HEADER_ROW + 1, columns[name])
+        ranges.append(f"{first_cell}:{first_cell.rstrip(string.digits)}")
+    values = [value_range[0] if value_range else []
+              for value_range in sheet.batch_get(ranges, major_dimension="COLUMNS",
+                                                 value_render_option="FORMULA")]
+    # the api drops trailing empty cells of each column, pad them back so the columns line up
+    row_count = max(map(len, values), default=0)
+    values = [numericise_all(column + [""] * (row_count - len(column)), empty2zero=False, default_blank="")
+              for column in values]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def get_image_url(cell):
+    match = IMAGE_FORMULA_RE.match(cell)
+    return match.group(1) if match else cell
+
+
 def generate_uuid():
     return str(uuid.uuid4())
 